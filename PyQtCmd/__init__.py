@@ -2,9 +2,10 @@
 # Original available here: https://python-forum.io/thread-25117.html
 
 
-import abc
-import collections
 import io
+import itertools
+import operator
+import sys
 import typing
 
 from PyQt5 import (
@@ -15,6 +16,20 @@ from PyQt5 import (
 
 _default_max_history = 100
 _default_max_lines = 1000
+# How many lines the display may exceed its maximum by before being trimmed
+_max_lines_slack = 64
+# Longer history entries are not interned
+_max_interned_length = 4096
+
+# Looked up on every key press
+_key_press = QtCore.QEvent.KeyPress
+_key_return = QtCore.Qt.Key_Return
+_key_up = QtCore.Qt.Key_Up
+_key_down = QtCore.Qt.Key_Down
+_key_tab = QtCore.Qt.Key_Tab
+
+# Text queued for display, with the format to display it in
+_PendingText = list[tuple[str, QtGui.QTextCharFormat | None]]
 
 
 class QCmdLineEdit(QtWidgets.QLineEdit):
@@ -46,48 +61,76 @@ class QCmdLineEdit(QtWidgets.QLineEdit):
         """
         super().__init__(parent=parent)
         self.expand_tab = expand_tab
-        self.history = collections.deque(maxlen=max_history)
+        self.max_history = max_history
         self.history_index = 0
-        self.history.appendleft('')
+        # Oldest entry first, so that entering a line appends to the end and
+        # recall by index is constant-time
+        self._history_list: list[str] = ['']
+        self._key_handlers: dict[int, typing.Callable[[], None]] = {
+            _key_return: self._enter_line,
+            _key_up: self._prev,
+            _key_down: self._next,
+        }
+
+    @property
+    def expand_tab(self) -> int | None:
+        return self._expand_tab
+
+    @expand_tab.setter
+    def expand_tab(self, expand_tab: int | None) -> None:
+        self._expand_tab = expand_tab
+        self._tab_str = '\t' if expand_tab is None else ' ' * expand_tab
+
+    @property
+    def history(self) -> tuple[str, ...]:
+        """
+        History entries, most recent first. The first entry is the line
+        currently being entered.
+        """
+        return tuple(reversed(self._history_list))
 
     def event(self, a0: QtCore.QEvent) -> bool:
         return self._intercept_tab(a0) or super().event(a0)
 
     def keyPressEvent(self, a0: QtGui.QKeyEvent) -> None:
-        if a0.key() == QtCore.Qt.Key_Return:
-            a0.accept()
-            self._enter_line()
-        elif a0.key() == QtCore.Qt.Key_Up:
-            a0.accept()
-            self._prev()
-        elif a0.key() == QtCore.Qt.Key_Down:
-            a0.accept()
-            self._next()
-        else:
+        handler = self._key_handlers.get(a0.key())
+        if handler is None:
             super().keyPressEvent(a0)
+        else:
+            # Key events are delivered already accepted; only the superclass
+            # implementation would ignore them
+            handler()
 
     def _intercept_tab(self, event: QtCore.QEvent) -> bool:
+        # Events of type KeyPress are always QKeyEvents, so checking the type
+        # first spares the other events any further inspection
         is_tab_press = (
-            isinstance(event, QtGui.QKeyEvent)
-            and event.type() == event.KeyPress
-            and event.key() == QtCore.Qt.Key_Tab
+            event.type() == _key_press
+            and event.key() == _key_tab
         )
         if is_tab_press:
-            tab = '\t' if self.expand_tab is None else ' ' * self.expand_tab
-            self.insert(tab)
+            self.insert(self._tab_str)
         return is_tab_press
 
     def _enter_line(self) -> None:
         text = self.text()
         self.line_entered.emit(text)
         if text:
+            # Repeated commands share a single string
+            if len(text) < _max_interned_length:
+                text = sys.intern(text)
             self.history_index = 0
-            self.history[0] = text
-            self.history.appendleft('')
+            self._history_list[-1] = text
+            self._history_list.append('')
+            if (
+                self.max_history is not None
+                and len(self._history_list) > self.max_history
+            ):
+                del self._history_list[0]
             self._update()
 
     def _prev(self) -> None:
-        if self.history_index < len(self.history) - 1:
+        if self.history_index < len(self._history_list) - 1:
             self.history_index += 1
             self._update()
 
@@ -97,7 +140,9 @@ class QCmdLineEdit(QtWidgets.QLineEdit):
             self._update()
 
     def _update(self) -> None:
-        self.setText(self.history[self.history_index])
+        entry = self._history_list[-1 - self.history_index]
+        if entry != self.text():
+            self.setText(entry)
 
 
 class QCmdConsole(QtWidgets.QWidget):
@@ -111,7 +156,13 @@ class QCmdConsole(QtWidgets.QWidget):
     interpreter if the input ends with '\n'.
     """
 
-    class Stream(abc.ABC, io.TextIOBase):
+    class Stream:
+        """
+        Minimal writable text stream, enough to stand in for `sys.stdout` and
+        friends.
+        """
+        __slots__ = ('parent', 'format', 'closed')
+        encoding = None
 
         def __init__(self,
                      parent: 'QCmdConsole',
@@ -119,26 +170,69 @@ class QCmdConsole(QtWidgets.QWidget):
                      ):
             self.parent = parent
             self.format = char_format
+            self.closed = False
+
+        def __enter__(self) -> 'QCmdConsole.Stream':
+            return self
+
+        def __exit__(self, *args) -> None:
+            self.close()
 
         def write(self, __s: str) -> int:
             self.parent._display_text(__s, self.format)
             return len(__s)
 
+        def writelines(self, __lines: typing.Iterable[str]) -> None:
+            for line in __lines:
+                self.write(line)
+
+        def flush(self) -> None:
+            pass
+
+        def close(self) -> None:
+            self.closed = True
+
+        def fileno(self) -> int:
+            raise io.UnsupportedOperation('fileno')
+
+        def read(self, __size: int | None = -1) -> str:
+            raise io.UnsupportedOperation('read')
+
+        def readline(self, __size: int | None = -1) -> str:
+            raise io.UnsupportedOperation('readline')
+
+        def isatty(self) -> bool:
+            return False
+
+        def readable(self) -> bool:
+            return False
+
+        def seekable(self) -> bool:
+            return False
+
+        def writable(self) -> bool:
+            return True
+
     class OutputStream(Stream):
-        pass
+        __slots__ = ()
 
     class InputStream(Stream):
+        __slots__ = ('buffer',)
 
         def __init__(self, parent, char_format):
             super().__init__(parent=parent, char_format=char_format)
-            self.buffer = io.StringIO()
+            self.buffer: list[str] = []
 
         def write(self, __s: str) -> int:
             super().write(__s)
-            self.buffer.write(__s)
-            if __s.endswith('\n'):
-                if not self.parent._exec(self.buffer.getvalue()):
-                    self.buffer = io.StringIO()
+            return self._accumulate(__s)
+
+        def _accumulate(self, __s: str) -> int:
+            # Buffer input without displaying it
+            self.buffer.append(__s)
+            if __s and __s[-1] == '\n':
+                if not self.parent._exec(''.join(self.buffer)):
+                    self.buffer.clear()
             return len(__s)
 
     def __init__(self,
@@ -165,7 +259,8 @@ class QCmdConsole(QtWidgets.QWidget):
         input.
         :param max_history: passed to `QCmdLineEdit` constructor
         :param max_lines: maximum number of input/output/error lines that can be
-        displayed. Lines are dropped FIFO.
+        displayed. Lines are dropped FIFO, in batches once the limit is
+        exceeded by a small margin.
         :param stdout_foreground: color for text from `stdout`. By default, it
         matches `stdin`.
         :param stderr_foreground: color for text from `stderr`. PBy default, it
@@ -174,13 +269,30 @@ class QCmdConsole(QtWidgets.QWidget):
         """
         super().__init__(parent=parent)
         self.interpreter = interpreter
-        self.prompt_text = prompt_text
-        self.line_continuing_prompt_text = line_continuing_prompt_text
+        self.prompt_text = sys.intern(prompt_text)
+        self.line_continuing_prompt_text = sys.intern(
+            line_continuing_prompt_text
+        )
 
         # Display previously entered lines and output from the interpreter
         self.display = QtWidgets.QPlainTextEdit(self)
         self.display.setReadOnly(True)
-        self.display.setMaximumBlockCount(max_lines)
+        # Excess lines are trimmed in batches by `_trim_display`, rather than
+        # one at a time by setting a maximum block count on the display.
+        # Setting a maximum block count would also disable undo history, which
+        # would otherwise keep every insertion and trimmed line in memory.
+        self.display.setUndoRedoEnabled(False)
+        self.max_lines = max_lines
+        self._default_format = self.display.currentCharFormat()
+        # Insert text through a dedicated cursor so that formats apply only to
+        # the inserted text rather than to the display's current format
+        self._cursor = QtGui.QTextCursor(self.display.document())
+        self._cursor.movePosition(QtGui.QTextCursor.End)
+
+        # Text written to the display is queued and inserted once per
+        # event-loop iteration, so that many small writes cost one layout pass
+        self._pending: _PendingText = []
+        self._flush_scheduled = False
 
         # Accept new input
         self.editor = QCmdLineEdit(max_history=max_history)
@@ -205,12 +317,15 @@ class QCmdConsole(QtWidgets.QWidget):
         self.setLayout(layout)
 
         # Use color to differentiate input, output and stderr
+        # Streams without a custom color share the stdin format
         stdin_format = self.display.currentCharFormat()
-        stdout_format = QtGui.QTextCharFormat(stdin_format)
-        stderr_format = QtGui.QTextCharFormat(stdin_format)
+        stdout_format = stdin_format
+        stderr_format = stdin_format
         if stdout_foreground is not None:
+            stdout_format = QtGui.QTextCharFormat(stdin_format)
             stdout_format.setForeground(stdout_foreground)
         if stderr_foreground is not None:
+            stderr_format = QtGui.QTextCharFormat(stdin_format)
             stderr_format.setForeground(stderr_foreground)
 
         self.stdin = self.InputStream(self, stdin_format)
@@ -221,8 +336,9 @@ class QCmdConsole(QtWidgets.QWidget):
             self.stdout.write(init_text)
 
     def _push(self, line: str) -> None:
-        self._display_text(self.prompt.text(), self.stdin.format)
-        self.stdin.write(line + '\n')
+        line += '\n'
+        self._display_text(self.prompt.text() + line, self.stdin.format)
+        self.stdin._accumulate(line)
 
     def _exec(self, input_: str) -> bool:
         more = self.interpreter(input_)
@@ -234,8 +350,84 @@ class QCmdConsole(QtWidgets.QWidget):
                       text: str,
                       char_format: QtGui.QTextCharFormat | None = None
                       ) -> None:
-        if char_format is not None:
-            self.display.setCurrentCharFormat(char_format)
-        self.display.insertPlainText(text)
+        self._pending.append((text, char_format))
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            QtCore.QTimer.singleShot(0, self._flush_display)
+
+    def _trim_display(self) -> None:
+        document = self.display.document()
+        excess = document.blockCount() - self.max_lines
+        if self.max_lines > 0 and excess > _max_lines_slack:
+            cursor = QtGui.QTextCursor(document)
+            cursor.movePosition(QtGui.QTextCursor.Start)
+            cursor.movePosition(QtGui.QTextCursor.NextBlock,
+                                QtGui.QTextCursor.KeepAnchor,
+                                excess)
+            cursor.removeSelectedText()
+
+    def _discard_overflow(self, pending: _PendingText) -> bool:
+        """
+        Drop queued text that would be trimmed right after being inserted,
+        keeping only the lines at the end of the queue that fill `max_lines`.
+        The kept text starts at the beginning of a line.
+
+        :return: whether any text was dropped, in which case the lines already
+        displayed should be cleared as well.
+        """
+        if self.max_lines <= 0:
+            return False
+        newlines = 0
+        for i in range(len(pending) - 1, -1, -1):
+            text, char_format = pending[i]
+            count = text.count('\n')
+            if newlines + count > self.max_lines:
+                # Keep the suffix of this chunk that follows the newline
+                # preceding the remaining number of lines
+                pos = len(text)
+                for _ in range(self.max_lines - newlines + 1):
+                    pos = text.rfind('\n', 0, pos)
+                pending[i] = (text[pos + 1:], char_format)
+                del pending[:i]
+                return True
+            newlines += count
+        return False
+
+    def _flush_display(self) -> None:
+        pending = self._pending
+        self._pending = []
+        self._flush_scheduled = False
+        cursor = self._cursor
+        # Only follow new output if the user hasn't scrolled away from it
         scroll = self.display.verticalScrollBar()
-        scroll.setValue(scroll.maximum())
+        at_bottom = scroll.value() == scroll.maximum()
+        document = self.display.document()
+        block_count = document.blockCount()
+        # Suppress the display's signals for each insertion and notify once
+        # for the whole batch instead
+        with QtCore.QSignalBlocker(self.display):
+            if self._discard_overflow(pending):
+                # The queue alone fills the display; clear it so that the kept
+                # lines are neither joined to nor preceded by older output
+                cursor.select(QtGui.QTextCursor.Document)
+                cursor.removeSelectedText()
+            cursor.movePosition(QtGui.QTextCursor.End)
+            # Insert consecutive chunks sharing a format as a single run, so
+            # the document splits the text into blocks once per run
+            for char_format, chunks in itertools.groupby(
+                pending,
+                key=operator.itemgetter(1)
+            ):
+                if char_format is None:
+                    char_format = self._default_format
+                cursor.insertText(''.join(text for text, _ in chunks),
+                                  char_format)
+            self._trim_display()
+        self.display.textChanged.emit()
+        if document.blockCount() != block_count:
+            self.display.blockCountChanged.emit(document.blockCount())
+        viewport = self.display.viewport()
+        viewport.update()
+        self.display.updateRequest.emit(viewport.rect(), 0)
+        if at_bottom:
+            scroll.setValue(scroll.maximum())